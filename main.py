@@ -1,32 +1,96 @@
 import os
+import posixpath
 import json
-import io
 import csv
 import base64
 import tempfile
+import threading
+import contextlib
 import requests
 import functions_framework
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import firestore, storage
 from cloudevents.http import CloudEvent
 
 # Maximum payload size for the API call (1MB).
 MAX_PAYLOAD_SIZE = 1048576  # bytes
 
+# Maximum number of blacklist API batches in flight at once.
+MAX_CONCURRENT_REQUESTS = 10
+
+# Shared HTTP session so connections to the blacklist API are reused across batches.
+# Lookups are read-only, so POSTs are retried with backoff on transient gateway errors.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_CONCURRENT_REQUESTS,
+    pool_maxsize=MAX_CONCURRENT_REQUESTS,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    ),
+))
+
+# Config documents are served from memory for this many seconds on warm instances.
+CONFIG_CACHE_TTL = 60  # seconds
+_CONFIG_CACHE = TTLCache(maxsize=128, ttl=CONFIG_CACHE_TTL)
+_CONFIG_CACHE_LOCK = threading.Lock()
+
+# Firestore and Storage clients, created on first use and reused across warm invocations.
+_FS_CLIENT = None
+_STORAGE_CLIENT = None
+
+
+def _fs():
+    global _FS_CLIENT
+    if _FS_CLIENT is None:
+        _FS_CLIENT = firestore.Client()
+    return _FS_CLIENT
+
+
+def _gcs():
+    global _STORAGE_CLIENT
+    if _STORAGE_CLIENT is None:
+        _STORAGE_CLIENT = storage.Client()
+    return _STORAGE_CLIENT
+
+
+@contextlib.contextmanager
+def _open_csv_upload(blob):
+    """
+    Opens blob for writing CSV text. The upload is only finalized if the block completes;
+    on an exception it is cancelled so no truncated file is left in the bucket.
+    """
+    blob_file = blob.open("wt", encoding="utf-8", newline="", content_type="text/csv")
+    try:
+        yield blob_file
+    except Exception:
+        # Closing the text wrapper would finalize the upload; cancel it instead.
+        blob_file.buffer.terminate()
+        raise
+    blob_file.close()
+
 
 @functions_framework.cloud_event
 def process_file_v2(cloudevent: CloudEvent):
     """
     Cloud Function (Gen2) entry point to process a CSV file.
     Steps:
-      1. Download CSV from Cloud Storage.
+      1. Decode the Pub/Sub message.
       2. Get config from Firestore to identify phone columns.
-      3. Extract phone numbers and batch them so that each API call payload is below 1MB.
-      4. Call the blacklist API in batches and aggregate the "supression" results.
-      5. If no suppressed numbers are returned, simply store the original file as cleanFilePath.
-      6. Otherwise, process the CSV:
-         - Create a clean file (emptying any suppressed phone numbers).
-         - Create a blacklisted file (only retaining suppressed numbers per lead, merging duplicates).
-      7. Upload generated files to Cloud Storage and update Firestore.
+      3. Stream the CSV from Cloud Storage and extract phone numbers.
+      4. Call the blacklist API in batches (each payload below 1MB) and aggregate the "supression" results.
+      5. If no suppressed numbers are returned, simply copy the original file as cleanFilePath.
+         Otherwise, stream the CSV a second time:
+         - Write a clean file (emptying any suppressed phone numbers) directly to Cloud Storage.
+         - Collect a blacklisted file (only retaining suppressed numbers per lead, merging duplicates).
+      6. Write the blacklisted file to Cloud Storage.
+      7. Update Firestore.
     """
     # --- Step 1. Decode the Pub/Sub message ---
     try:
@@ -47,96 +111,95 @@ def process_file_v2(cloudevent: CloudEvent):
 
     print(f"Processing fileId: {file_id}, fileName: {file_name}, bucket: {bucket_name}, config path: {config_doc_path}")
 
-    # --- Step 2. Initialize Firestore and Storage clients ---
-    fs_client = firestore.Client()
-    storage_client = storage.Client()
+    # --- Step 2. Get Firestore and Storage clients (cached across warm invocations) ---
+    fs_client = _fs()
+    storage_client = _gcs()
 
-    # Fetch configuration document from Firestore.
+    # Fetch configuration document from Firestore (or the warm-instance cache).
     config_ref = fs_client.document(config_doc_path)
-    config_snapshot = config_ref.get()
-    if not config_snapshot.exists:
+    config = get_config(config_ref, file_id)
+    if config is None:
         print(f"Configuration document not found: {config_doc_path}")
         return
-    config = config_snapshot.to_dict()
 
     # Retrieve dynamic configuration details.
-    phone_indexes = config.get("phoneColumnIndexes", [])
+    phone_indexes = tuple(config.get("phoneColumnIndexes", []))
     has_header = config.get("hasHeaderRow", True)
 
-    # --- Step 3. Download and parse the CSV file ---
+    # --- Step 3. Stream the CSV file and extract unique phone numbers ---
     bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(os.path.join('uploads', file_name))
+    blob_name = f"uploads/{file_name}"
+    header = None
+    data_row_count = 0
+    phone_set = set()
     try:
-        file_content = blob.download_as_bytes()
+        # The file is read more than once; pin every read to the generation that exists now
+        # so a re-upload during processing can't mix two versions of the file.
+        blob = bucket.blob(blob_name)
+        blob.reload()
+        blob = bucket.blob(blob_name, generation=blob.generation)
+        with blob.open("rt", encoding="utf-8", newline="") as csv_file:
+            reader = csv.reader(csv_file)
+            # Separate header from data rows if needed.
+            if has_header:
+                header = next(reader, None)
+            for row in reader:
+                data_row_count += 1
+                row_len = len(row)
+                for idx in phone_indexes:
+                    if idx < row_len:
+                        phone = row[idx].strip()
+                        if phone:
+                            phone_set.add(phone)
     except Exception as e:
         print(f"Error downloading file: {e}")
         return
 
-    decoded_file = file_content.decode('utf-8')
-    csv_lines = decoded_file.splitlines()
-    reader = csv.reader(csv_lines)
-    rows = list(reader)
-    if not rows:
+    if header is None and not data_row_count:
         print("Empty CSV file.")
         return
 
-    # Separate header from data rows if needed.
-    if has_header:
-        header = rows[0]
-        data_rows = rows[1:]
-    else:
-        header = None
-        data_rows = rows
+    total_count = len(phone_set)
+    print(f"Extracted {total_count} unique phone numbers for API lookup.")
 
-    # --- Step 4. Extract unique phone numbers ---
-    phone_set = set()
-    for row in data_rows:
-        for idx in phone_indexes:
-            if idx < len(row):
-                phone = row[idx].strip()
-                if phone:
-                    phone_set.add(phone)
-    phone_list = list(phone_set)
-    print(f"Extracted {len(phone_list)} unique phone numbers for API lookup.")
-
-    # --- Step 5. Call the blacklist API in batches ---
+    # --- Step 4. Call the blacklist API in batches ---
     try:
-        suppressed_list = call_blacklist_lookup_batched(phone_list)
+        suppressed_set = call_blacklist_lookup_batched(phone_set)
     except Exception as e:
         print(f"Error calling blacklist API: {e}")
         return
 
-    suppressed_set = set(suppressed_list)
+    dnc_count = len(suppressed_set)
     print(f"Aggregated suppressed numbers: {suppressed_set}")
 
-    # Update Firestore stage.
-    config_ref.update({
-        "status": {
-            "stage": "API_CALLED",
-            "lastUpdated": firestore.SERVER_TIMESTAMP
-        }
-    })
+    output_bucket_name = os.getenv("OUTPUT_BUCKET")
+    if not output_bucket_name:
+        print("OUTPUT_BUCKET environment variable is not set.")
+        return
+    output_bucket = storage_client.bucket(output_bucket_name)
+
+    # Object names always use "/", so split with posixpath regardless of the host OS.
+    base_name, ext = posixpath.splitext(file_name)
+    clean_file_name = f"{base_name}_clean{ext}"
+    clean_blob_name = f"{file_id}/{clean_file_name}"
+    clean_blob = output_bucket.blob(clean_blob_name)
 
     # --- Special Case: No suppressed numbers ---
     if not suppressed_set:
-        print("No suppressed numbers returned. Uploading original file as cleanFilePath.")
-        output_bucket_name = os.getenv("OUTPUT_BUCKET")
-        if not output_bucket_name:
-            print("OUTPUT_BUCKET environment variable is not set.")
-            return
-        output_bucket = storage_client.bucket(output_bucket_name)
-        # Upload the original file content as the clean file.
-        base_name, ext = os.path.splitext(file_name)
-        clean_file_name = f"{base_name}_clean{ext}"
-        clean_blob_name = f"{file_id}/{clean_file_name}"
-        clean_blob = output_bucket.blob(clean_blob_name)
-        clean_blob.upload_from_string(decoded_file, content_type="text/csv")
+        print("No suppressed numbers returned. Copying original file as cleanFilePath.")
+        # Copy the original file server-side with rewrite, which also handles large objects
+        # across locations and storage classes. Like the processed path, this overwrites
+        # any clean file left by an earlier run of the same file.
+        clean_blob.content_type = "text/csv"
+        token, _, _ = clean_blob.rewrite(blob)
+        while token is not None:
+            token, _, _ = clean_blob.rewrite(blob, token=token)
 
         # Update Firestore with output path.
         config_ref.update({
             "results" : {
-                "total": len(phone_list),
-                "clean": len(phone_list),
+                "total": total_count,
+                "clean": total_count,
                 "dnc": 0
             },
             "outputFiles": {
@@ -151,101 +214,85 @@ def process_file_v2(cloudevent: CloudEvent):
         print(f"Processed file_id={file_id}. Clean file uploaded to: {clean_blob_name}")
         return
 
-    # --- Step 6. Process CSV rows for clean and blacklisted outputs ---
-    clean_rows = []
+    suppressed_file_name = f"{base_name}_blacklisted{ext}"
+    suppressed_blob_name = f"{file_id}/{suppressed_file_name}"
+    suppressed_blob = output_bucket.blob(suppressed_blob_name)
+
+    # --- Step 5. Stream CSV rows again, writing the clean file as we go ---
     suppressed_dict = {}  # Group suppressed rows by lead_id (assumed to be in column 0)
 
-    # Add header if present.
-    if header:
-        clean_rows.append(header)
-        suppressed_header = header[:]  # Copy for suppressed file
-    else:
-        suppressed_header = None
-
-    for row in data_rows:
-        clean_row = list(row)       # For clean file: clear suppressed phones.
-        suppressed_row = list(row)  # For blacklisted file: retain only suppressed phones.
-        row_has_suppressed = False
-
-        for idx in phone_indexes:
-            if idx < len(row):
-                phone_val = row[idx].strip()
-                if phone_val in suppressed_set:
+    # The clean file is only finalized after the blacklisted file has been written, so a
+    # failure while processing rows or writing the blacklisted file leaves neither output behind.
+    try:
+        with blob.open("rt", encoding="utf-8", newline="") as csv_file, \
+                _open_csv_upload(clean_blob) as clean_file:
+            reader = csv.reader(csv_file)
+            writer_clean = csv.writer(clean_file)
+
+            # Skip the header row; it was captured in the first pass.
+            if has_header:
+                next(reader, None)
+            if header:
+                writer_clean.writerow(header)
+
+            write_clean_row = writer_clean.writerow
+            for row in reader:
+                row_len = len(row)
+                suppressed_indexes = [
+                    idx for idx in phone_indexes
+                    if idx < row_len and row[idx].strip() in suppressed_set
+                ]
+                # Most rows have no suppressed phones; write them through without copying.
+                if not suppressed_indexes:
+                    write_clean_row(row)
+                    continue
+
+                clean_row = list(row)       # For clean file: clear suppressed phones.
+                suppressed_row = list(row)  # For blacklisted file: retain only suppressed phones.
+                for idx in phone_indexes:
+                    if idx < row_len:
+                        # Clear non-suppressed phone cells in the suppressed file.
+                        suppressed_row[idx] = ""
+                for idx in suppressed_indexes:
                     # For clean file, empty the cell.
                     clean_row[idx] = ""
                     # For suppressed file, keep the suppressed number.
-                    suppressed_row[idx] = phone_val
-                    row_has_suppressed = True
+                    suppressed_row[idx] = row[idx].strip()
+                write_clean_row(clean_row)
+
+                # Group rows with suppressed numbers by lead_id.
+                lead_id = row[0] if row_len > 0 else None
+                if lead_id in suppressed_dict:
+                    existing_row = suppressed_dict[lead_id]
+                    for idx in phone_indexes:
+                        # Merge suppressed phone numbers for the same lead.
+                        if idx < row_len and not existing_row[idx] and suppressed_row[idx]:
+                            existing_row[idx] = suppressed_row[idx]
+                    suppressed_dict[lead_id] = existing_row
                 else:
-                    # Clear non-suppressed phone cells in the suppressed file.
-                    suppressed_row[idx] = ""
-        clean_rows.append(clean_row)
-
-        # Group rows with suppressed numbers by lead_id.
-        if row_has_suppressed:
-            lead_id = row[0] if len(row) > 0 else None
-            if lead_id in suppressed_dict:
-                existing_row = suppressed_dict[lead_id]
-                for idx in phone_indexes:
-                    # Merge suppressed phone numbers for the same lead.
-                    if idx < len(row) and not existing_row[idx] and suppressed_row[idx]:
-                        existing_row[idx] = suppressed_row[idx]
-                suppressed_dict[lead_id] = existing_row
-            else:
-                suppressed_dict[lead_id] = suppressed_row
-
-    # Build suppressed file rows.
-    suppressed_rows = []
-    if suppressed_header:
-        suppressed_rows.append(suppressed_header)
-    suppressed_rows.extend(suppressed_dict.values())
-
-    # --- Step 7. Write the output CSV files in memory ---
-    clean_csv_output = io.StringIO()
-    writer_clean = csv.writer(clean_csv_output)
-    for row in clean_rows:
-        writer_clean.writerow(row)
-    clean_csv_content = clean_csv_output.getvalue()
-
-    suppressed_csv_output = io.StringIO()
-    writer_suppressed = csv.writer(suppressed_csv_output)
-    if suppressed_header:
-        writer_suppressed.writerow(suppressed_header)
-    for row in (list(suppressed_dict.values()) if not suppressed_header else suppressed_rows[1:]):
-        writer_suppressed.writerow(row)
-    suppressed_csv_content = suppressed_csv_output.getvalue()
-
-    # --- Step 8. Upload generated files to Cloud Storage ---
-    output_bucket_name = os.getenv("OUTPUT_BUCKET")
-    if not output_bucket_name:
-        print("OUTPUT_BUCKET environment variable is not set.")
+                    suppressed_dict[lead_id] = suppressed_row
+
+            # --- Step 6. Write the blacklisted CSV file to Cloud Storage ---
+            with _open_csv_upload(suppressed_blob) as suppressed_file:
+                writer_suppressed = csv.writer(suppressed_file)
+                if header:
+                    writer_suppressed.writerow(header)
+                writer_suppressed.writerows(suppressed_dict.values())
+    except Exception as e:
+        print(f"Error processing file: {e}")
         return
-    output_bucket = storage_client.bucket(output_bucket_name)
-
-    base_name, ext = os.path.splitext(file_name)
-    clean_file_name = f"{base_name}_clean{ext}"
-    suppressed_file_name = f"{base_name}_blacklisted{ext}"
-
-    clean_blob_name = f"{file_id}/{clean_file_name}"
-    suppressed_blob_name = f"{file_id}/{suppressed_file_name}"
-
-    clean_blob = output_bucket.blob(clean_blob_name)
-    suppressed_blob = output_bucket.blob(suppressed_blob_name)
-
-    clean_blob.upload_from_string(clean_csv_content, content_type="text/csv")
-    suppressed_blob.upload_from_string(suppressed_csv_content, content_type="text/csv")
 
     output_paths = {
         "cleanFilePath": clean_blob_name,
         "blacklistedFilePath": suppressed_blob_name
     }
 
-    # --- Step 9. Update Firestore with output file paths and final status ---
+    # --- Step 7. Update Firestore with output file paths and final status ---
     config_ref.update({
         "results": {
-            "total": len(phone_list),
-            "clean": len(phone_list) - len(suppressed_set),
-            "dnc": len(suppressed_set)
+            "total": total_count,
+            "clean": total_count - dnc_count,
+            "dnc": dnc_count
         },
         "outputFiles": output_paths,
         "status": {
@@ -257,32 +304,57 @@ def process_file_v2(cloudevent: CloudEvent):
     print(f"Processed file_id={file_id}. Clean file uploaded to: {clean_blob_name}")
     print(f"Processed file_id={file_id}. Blacklisted file uploaded to: {suppressed_blob_name}")
 
-def call_blacklist_lookup_batched(phone_list):
+def get_config(config_ref, file_id):
+    """
+    Returns the config document behind config_ref as a dict, or None if it does not exist.
+    Found documents are cached for CONFIG_CACHE_TTL seconds, but a cached copy is only
+    served to a different file than the one that read it. The document is also the
+    job's status record, so reprocessing the same file (e.g. after fixing its config)
+    always reads it fresh.
+    """
+    with _CONFIG_CACHE_LOCK:
+        cached = _CONFIG_CACHE.get(config_ref.path)
+    if cached is not None and cached[1] != file_id:
+        return cached[0]
+
+    config_snapshot = config_ref.get()
+    if not config_snapshot.exists:
+        return None
+    config = config_snapshot.to_dict()
+    with _CONFIG_CACHE_LOCK:
+        _CONFIG_CACHE[config_ref.path] = (config, file_id)
+    return config
+
+def call_blacklist_lookup_batched(phones):
     """
-    Breaks the phone_list into batches such that each JSON payload ({"phones": batch})
-    is less than MAX_PAYLOAD_SIZE (1MB). It then calls the API for each batch and
-    aggregates the suppressed numbers.
+    Breaks the phones into batches such that each JSON payload ({"phones": batch})
+    is less than MAX_PAYLOAD_SIZE (1MB). It then calls the API for all batches
+    concurrently and returns the set of suppressed numbers.
     """
+    # Size of the serialized payload with an empty list; json.dumps uses ", " between items.
+    base_size = len(json.dumps({"phones": []}))
     batches = []
     current_batch = []
-    for phone in phone_list:
+    current_size = base_size
+    for phone in phones:
+        # json.dumps escapes to ASCII, so its length is the encoded byte count.
+        delta = len(json.dumps(phone)) + (2 if current_batch else 0)
+        # If adding this phone would exceed the limit, finalize the batch and start a new one.
+        if current_batch and current_size + delta > MAX_PAYLOAD_SIZE:
+            batches.append(current_batch)
+            current_batch = []
+            current_size = base_size
+            delta = len(json.dumps(phone))
         current_batch.append(phone)
-        payload = {"phones": current_batch}
-        payload_str = json.dumps(payload)
-        # Check size in bytes; if over the limit, remove the last phone and finalize the batch.
-        if len(payload_str.encode('utf-8')) > MAX_PAYLOAD_SIZE:
-            current_batch.pop()
-            if current_batch:
-                batches.append(current_batch)
-            current_batch = [phone]
+        current_size += delta
     if current_batch:
         batches.append(current_batch)
 
     suppressed = set()
-    for batch in batches:
-        suppressed_batch = call_blacklist_lookup(batch)
-        suppressed.update(suppressed_batch)
-    return list(suppressed)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        for suppressed_batch in executor.map(call_blacklist_lookup, batches):
+            suppressed.update(suppressed_batch)
+    return suppressed
 
 def call_blacklist_lookup(phone_batch):
     """
@@ -298,7 +370,7 @@ def call_blacklist_lookup(phone_batch):
         "accept": "application/json",
         "content-type": "application/json"
     }
-    response = requests.post(api_url, json=payload, headers=headers)
+    response = _SESSION.post(api_url, json=payload, headers=headers)
     if response.status_code != 200:
         raise Exception(f"Blacklist API call failed: {response.status_code} - {response.text}")
     response_json = response.json()